@@ -6,13 +6,32 @@ isopy – install isolated CPython builds & integrate them with Poetry
 
 from __future__ import annotations
 
-import argparse, json, os, re, shutil, subprocess, sys, tarfile, tempfile, time
+import argparse, functools, hashlib, io, os, re, shutil, subprocess, sys, tarfile, tempfile, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
 from pathlib import Path
-from urllib.request import urlopen, Request
-from urllib.error import URLError, HTTPError
+
+import urllib3
+
+try:                                    # flock есть только на POSIX
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:                                    # orjson заметно быстрее; оба парсят bytes без decode
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
 
 __version__   = "0.2.0"
 
+def _env_int(name: str, default: int) -> int:
+    """int из окружения; мусор не должен ронять импорт (его делает plugin.py при каждом poetry)"""
+    try:
+        return int(os.getenv(name, default))
+    except ValueError:
+        return default
+
 # ───────────── настраиваемые «константы» ─────────────────────────────────────
 ISOPY_HOME    = Path.home() / ".isopy"
 ARCH          = os.getenv("ISOPY_ARCH", "x86_64-unknown-linux-gnu")
@@ -20,52 +39,380 @@ INDEX_URL     = os.getenv("ISOPY_INDEX_URL",
                 "https://raw.githubusercontent.com/"
                 "rexologue/isopy/main/index.json")      # поменяйте на свой
 CACHE_FILE    = Path.home() / ".cache" / "isopy" / "index.json"
-CACHE_TTL     = 12 * 60 * 60        # 12 ч
+ETAG_FILE     = CACHE_FILE.with_suffix(".etag")
+LOCK_FILE     = CACHE_FILE.with_suffix(".lock")
+BLOB_DIR      = CACHE_FILE.parent / "blobs"       # скачанные архивы: <sha256>.tar.{gz|zst}
+CACHE_TTL     = _env_int("ISOPY_CACHE_TTL", 0)    # 0 → TTL по свежести релизов
+CACHE_TTL_MIN = 60 * 60             # 1 ч   — релиз был вчера
+CACHE_TTL_MAX = 7 * 24 * 60 * 60    # 7 дн  — релизов не было полгода
+READ_BUF      = 128 * 1024          # буфер чтения HTTP-ответа (как в uv)
+POOL_SIZE     = 8                   # соединений на хост
+DL_PARTS      = min(_env_int("ISOPY_DL_PARTS", 4), POOL_SIZE)  # Range-кусков
+DL_PARTS_MIN  = 8 << 20             # архивы меньше качаем одним потоком
+SPOOL_MAX     = 64 << 20            # до стольких байт Range-загрузка живёт в RAM
 
 _RX_BRANCH    = re.compile(r"^\d+\.\d+$")      # 3.12
 _RX_FULL      = re.compile(r"^\d+\.\d+\.\d+$") # 3.12.10
+_RX_BUILD     = re.compile(r"/download/(\d{8})/") # …/download/20250723/…
+
+# ───────────── HTTP ──────────────────────────────────────────────────────────
+# один пул на процесс: index.json и архив идут по уже открытому TLS-соединению
+_POOL = urllib3.PoolManager(
+    num_pools=4, maxsize=POOL_SIZE,
+    retries=urllib3.Retry(3, backoff_factor=0.5, status_forcelist=[502, 503, 504]),
+)
+
+def _get(url: str, headers: dict[str, str] | None = None,
+         ok: tuple[int, ...] = (200,), method: str = "GET", **kw) -> urllib3.HTTPResponse:
+    """GET через общий пул; статус не из ok → urllib3.exceptions.HTTPError"""
+    hdrs = {"User-Agent": f"isopy/{__version__}", **(headers or {})}
+    r = _POOL.request(method, url, headers=hdrs, **kw)
+    if r.status not in ok:
+        r.release_conn()
+        raise urllib3.exceptions.HTTPError(f"HTTP {r.status} for {url}")
+    return r
 
 # ───────────── index handling ────────────────────────────────────────────────
-def _download_index() -> dict[str, str]:
+def _write_atomic(path: Path, data: bytes) -> None:
+    """Пишем рядом и подменяем rename'ом: читатель не увидит полфайла"""
+    tmp = path.with_name(f"{path.name}.tmp.{os.getpid()}")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+def _fetch_index() -> dict[str, str]:
     print("⇣  Fetching version index…")
-    hdrs = {"User-Agent": f"isopy/{__version__}"}
+    hdrs, cached = {}, None
+    if CACHE_FILE.exists() and ETAG_FILE.exists():    # условный GET: 304 вместо всего JSON
+        try:
+            cached = _loads(CACHE_FILE.read_bytes())
+        except ValueError:
+            pass                                      # битый кэш — 304 нам не поможет
+    if cached is not None:
+        hdrs["If-None-Match"] = ETAG_FILE.read_text().strip()
     try:
-        with urlopen(Request(INDEX_URL, headers=hdrs), timeout=10) as r:
-            data = r.read()
-    except (URLError, HTTPError) as e:
+        r = _get(INDEX_URL, hdrs, ok=(200, 304), timeout=10)
+    except urllib3.exceptions.HTTPError as e:
         sys.exit(f"❌  Cannot download index.json ({e}). "
                  "Set ISOPY_INDEX_URL or use offline cache.")
+    if r.status == 304:
+        os.utime(CACHE_FILE)                           # кэш актуален — продлеваем TTL
+        return cached
+    data = r.data
+    _write_atomic(CACHE_FILE, data)
+    if etag := r.headers.get("ETag"):
+        _write_atomic(ETAG_FILE, etag.encode())
+    else:
+        ETAG_FILE.unlink(missing_ok=True)
+    return _loads(data)
+
+def _download_index() -> dict[str, str]:
     CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
-    CACHE_FILE.write_bytes(data)
-    return json.loads(data)
+    with open(LOCK_FILE, "w") as lock:
+        if fcntl:                                      # параллельные запуски качают по очереди
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        if index := _cached_index():                   # пока ждали, сосед уже обновил кэш
+            return index
+        return _fetch_index()
+
+def _cache_ttl(index: dict[str, str]) -> float:
+    """TTL кэша: N дней с последнего релиза → N часов, в пределах [1 ч, 7 дн]"""
+    if CACHE_TTL:
+        return CACHE_TTL
+    builds = [m.group(1) for url in index.values() if (m := _RX_BUILD.search(url))]
+    if not builds:
+        return CACHE_TTL_MIN
+    age = time.time() - time.mktime(time.strptime(max(builds), "%Y%m%d"))
+    return min(CACHE_TTL_MAX, max(CACHE_TTL_MIN, age / 24))
+
+def _cached_index() -> dict[str, str] | None:
+    """Кэш индекса, если он на месте и ещё не протух"""
+    if CACHE_FILE.exists():
+        try:
+            index = _loads(CACHE_FILE.read_bytes())
+        except ValueError:
+            return None                                # битый кэш — просто перекачаем
+        if index and time.time() - CACHE_FILE.stat().st_mtime < _cache_ttl(index):
+            return index
+    return None
 
 def _load_index() -> dict[str, str]:
-    if CACHE_FILE.exists() and time.time() - CACHE_FILE.stat().st_mtime < CACHE_TTL:
-        return json.loads(CACHE_FILE.read_text())
-    return _download_index()
+    return _cached_index() or _download_index()
 
-INDEX: dict[str, str] = _load_index()
+@functools.lru_cache(maxsize=1)
+def _index() -> dict[str, str]:
+    """Индекс грузится лениво и один раз: list и плагин Poetry в сеть не ходят"""
+    return _load_index()
 
 # ───────────── helpers ───────────────────────────────────────────────────────
+@functools.lru_cache(maxsize=1)
+def _branch_heads() -> dict[str, str]:
+    """{'3.12': '3.12.11', …} — один проход по индексу, каждая версия парсится раз"""
+    heads: dict[str, tuple[tuple[int, ...], str]] = {}
+    for v in _index():
+        key = tuple(map(int, v.split(".")))
+        branch = f"{key[0]}.{key[1]}"
+        if branch not in heads or key > heads[branch][0]:
+            heads[branch] = (key, v)
+    return {b: v for b, (_, v) in heads.items()}
+
 def _latest(branch: str) -> str | None:
-    """'3.12' → самая свежая '3.12.x' из INDEX"""
-    vers = [v for v in INDEX if v.startswith(branch + ".")]
-    return max(vers, key=lambda s: tuple(map(int, s.split(".")))) if vers else None
-
-def _download(url: str, dest: Path) -> None:
-    print(f"⬇  {url.split('/')[-1]}")
-    with urlopen(Request(url, headers={"Accept": "application/octet-stream"})) as r,\
-         tempfile.NamedTemporaryFile(delete=False) as tmp:
-        shutil.copyfileobj(r, tmp)
-    print(f"📦  Extracting → {dest}")
-    dest.mkdir(parents=True, exist_ok=True)
-    with tarfile.open(tmp.name) as tar:
-        members=[m for m in tar.getmembers() if m.name.startswith("python/")]
-        for m in members: m.path="/".join(m.name.split("/")[1:])
-        tar.extractall(dest, members)
-    os.unlink(tmp.name)
-
-def _ensure(ver: str) -> Path:
+    """'3.12' → самая свежая '3.12.x' из индекса"""
+    return _branch_heads().get(branch)
+
+def _open_tar(url: str, fileobj) -> tarfile.TarFile:
+    """Потоковый tar поверх HTTP-ответа: .tar.gz / .tar.zst"""
+    if url.endswith(".tar.zst"):
+        try:
+            import zstandard
+        except ImportError:
+            if sys.version_info >= (3, 14):            # compression.zstd из stdlib
+                return tarfile.open(fileobj=fileobj, mode="r|zst")
+            sys.exit("❌  .tar.zst archives need the 'zstandard' package.")
+        # архив может состоять из нескольких zstd-фреймов — читаем до конца, а не до первого
+        reader = zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+        return tarfile.open(fileobj=reader, mode="r|")
+    return tarfile.open(fileobj=fileobj, mode="r|gz")
+
+def _tar_cmd(url: str, dest: Path) -> list[str] | None:
+    """Команда системного tar (+pigz/pzstd, если есть) или None → tarfile"""
+    tar = shutil.which("tar")
+    if url.endswith(".tar.zst"):
+        prog = shutil.which("pzstd") or shutil.which("zstd")
+    else:
+        prog = shutil.which("pigz") or shutil.which("gzip")
+    if not (tar and prog):
+        return None
+    return [tar, f"--use-compress-program={prog}", "-xf", "-", "-C", str(dest),
+            "--strip-components=1", "python"]
+
+def _extract_tar(cmd: list[str], chunks) -> None:
+    """Скармливаем архив в stdin внешнего tar"""
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    try:
+        for chunk in chunks:
+            proc.stdin.write(chunk)
+        proc.stdin.close()
+    except BrokenPipeError:
+        pass                        # tar упал раньше — код возврата скажет почему
+    except urllib3.exceptions.HTTPError as e:
+        proc.kill(); proc.wait()    # соединение оборвалось посреди архива
+        sys.exit(f"❌  Cannot download archive ({e}).")
+    if proc.wait():
+        sys.exit(f"❌  tar exited with code {proc.returncode}.")
+
+def _extract_py(url: str, src, dest: Path) -> None:
+    """Fallback: потоковая распаковка через tarfile"""
+    with _open_tar(url, src) as tar:
+        # next() вместо итератора: TarFile копит все TarInfo в .members,
+        # а нам хватает одного заголовка за раз
+        seen = False                    # python/ идёт в архиве одним блоком
+        while (m := tar.next()) is not None:
+            tar.members.clear()
+            if not m.name.startswith("python/"):
+                if seen: break          # блок кончился — хвост не читаем
+                continue
+            seen = True
+            m.path = m.name[len("python/"):]
+            if m.islnk(): m.linkname = m.linkname[len("python/"):]
+            tar.extract(m, dest)
+
+def _extract(cmd: list[str] | None, url: str, src, dest: Path, drain: bool = False) -> None:
+    if cmd: _extract_tar(cmd, iter(functools.partial(src.read, 1 << 20), b""))
+    else:   _extract_py(url, src, dest)
+    if drain:                           # дочитываем хвост, чтобы _BlobTee увидел весь архив
+        while src.read(1 << 20): pass
+
+class _BlobTee:
+    """Обёртка над src: прочитанное пишется в blobs/ и хэшируется на лету"""
+
+    def __init__(self, blob: Path):
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        self.blob, self.src = blob, None
+        self.tmp  = blob.with_name(f"{blob.name}.tmp.{os.getpid()}")
+        self.sink = open(self.tmp, "wb")
+        self.sha  = hashlib.sha256()
+
+    def wrap(self, src) -> _BlobTee:
+        self.src = src
+        return self
+
+    def read(self, n: int = -1) -> bytes:
+        data = self.src.read(n)
+        self.sink.write(data)
+        self.sha.update(data)
+        return data
+
+    def close(self) -> None:
+        self.src.close()
+
+    def commit(self, sha256: str | None) -> bool:
+        """В кэш кладём только архив, чей sha256 совпал с индексом"""
+        self.sink.close()
+        if self.sha.hexdigest() == sha256:
+            os.replace(self.tmp, self.blob)
+            return True
+        self.tmp.unlink(missing_ok=True)
+        return False
+
+def _probe_ranges(url: str) -> tuple[str, int] | None:
+    """HEAD → (URL после редиректов, размер), если архив стоит качать кусками"""
+    try:
+        r = _get(url, method="HEAD")
+    except urllib3.exceptions.HTTPError:
+        return None
+    size = int(r.headers.get("Content-Length") or 0)
+    if r.headers.get("Accept-Ranges") != "bytes" or size < DL_PARTS_MIN:
+        return None
+    if r.retries and r.retries.history:         # Range-запросы сразу на CDN, без 302
+        url = urljoin(url, r.retries.history[-1].redirect_location)
+    return url, size
+
+def _download_parts(url: str, size: int, f) -> bool:
+    """Range-куски параллельно, каждый на своё место в f; False → сервер не отдал 206"""
+    step = -(-size // DL_PARTS)
+    lock = threading.Lock()             # seek+write у SpooledTemporaryFile не атомарны
+
+    def part(start: int) -> bool:
+        end = min(start + step, size) - 1
+        r = _get(url, {"Range": f"bytes={start}-{end}"}, ok=(200, 206), preload_content=False)
+        if r.status != 206:
+            r.close()                   # Range проигнорирован — весь файл нам тут не нужен
+            return False
+        try:
+            for chunk in r.stream(1 << 20):
+                with lock:
+                    f.seek(start)
+                    f.write(chunk)
+                start += len(chunk)
+        finally:
+            r.release_conn()
+        if start != end + 1:
+            raise urllib3.exceptions.HTTPError(f"short read at byte {start} of {url}")
+        return True
+
+    with ThreadPoolExecutor(DL_PARTS) as ex:
+        return all(list(ex.map(part, range(0, size, step))))
+
+def _pump(r) -> tuple[io.BufferedReader, threading.Thread, list[Exception]]:
+    """Фоновый поток льёт ответ в os.pipe(); читающий конец отдаём tarfile"""
+    rfd, wfd = os.pipe()
+    errors: list[Exception] = []
+
+    def run() -> None:
+        try:
+            with os.fdopen(wfd, "wb", READ_BUF) as w:
+                shutil.copyfileobj(r, w, 1 << 20)
+        except BrokenPipeError:
+            pass                        # читатель закончил раньше (python/ кончился)
+        except Exception as e:
+            errors.append(e)
+
+    pump = threading.Thread(target=run, daemon=True)
+    pump.start()
+    return os.fdopen(rfd, "rb", READ_BUF), pump, errors
+
+def _split_hash(url: str) -> tuple[str, str | None]:
+    """'…tar.gz#sha256=<hex>' → ('…tar.gz', '<hex>')"""
+    url, _, frag = url.partition("#")
+    return url, (frag[len("sha256="):] if frag.startswith("sha256=") else None)
+
+def _download(url: str, dest: Path, sha256: str | None = None) -> None:
+    name = url.split('/')[-1]
+    ext  = ".tar.zst" if url.endswith(".tar.zst") else ".tar.gz"
+    blob = BLOB_DIR / f"{sha256}{ext}" if sha256 else None
+    # распаковываем рядом и переименовываем в dest только целиком:
+    # оборванная загрузка не должна оставлять bin/python при битом lib/
+    for stale in dest.parent.glob(f".{dest.name}.partial.*"):  # от убитых запусков
+        shutil.rmtree(stale, ignore_errors=True)
+    part = Path(tempfile.mkdtemp(dir=dest.parent, prefix=f".{dest.name}.partial."))
+    part.chmod(0o755)                   # mkdtemp создаёт 0700, а dest должен быть как обычно
+    cmd = _tar_cmd(url, part)
+    try:
+        cached = blob and blob.exists()
+        if cached:                      # этот архив уже качали — сеть не нужна
+            print(f"♻  {name} (cached)")
+            print(f"📦  Extracting → {dest}")
+            if not (cached := _from_blob(url, blob, sha256, cmd, part)):
+                shutil.rmtree(part)     # что успело распаковаться из битого блоба
+                part.mkdir(0o755)
+        if not cached:
+            print(f"⬇  {name}")
+            print(f"📦  Extracting → {dest}")
+            _fetch_cached(url, part, cmd, blob, sha256)
+    except BaseException:
+        shutil.rmtree(part, ignore_errors=True)
+        raise
+    shutil.rmtree(dest, ignore_errors=True)         # остатки прежней неудачной установки
+    os.replace(part, dest)
+
+def _from_blob(url: str, blob: Path, sha256: str, cmd: list[str] | None, dest: Path) -> bool:
+    """Распаковать архив из blobs/; False — блоб битый (и уже удалён), качаем заново"""
+    sha = hashlib.sha256()
+    with open(blob, "rb") as f:
+        for chunk in iter(functools.partial(f.read, 1 << 20), b""):
+            sha.update(chunk)
+        if sha.hexdigest() == sha256:   # обрезанный/испорченный блоб в tar не пускаем
+            f.seek(0)
+            try:
+                _extract(cmd, url, f, dest)
+                return True
+            except (tarfile.TarError, EOFError, SystemExit):
+                pass                    # tar отказался — блобу тоже не верим
+    blob.unlink(missing_ok=True)
+    print("⚠  Cached archive is corrupt — downloading again.")
+    return False
+
+def _fetch_cached(url: str, dest: Path, cmd: list[str] | None,
+                  blob: Path | None, sha256: str | None) -> None:
+    """Скачать и распаковать, попутно положив архив в blobs/ (если известен sha256)"""
+    tee  = _BlobTee(blob) if blob else None
+    wrap = tee.wrap if tee else (lambda src: src)
+    try:
+        _fetch_extract(url, dest, cmd, wrap, drain=bool(tee))
+    except BaseException:
+        if tee: tee.commit(None)        # недокачанное в кэш не кладём
+        raise
+    if tee and not tee.commit(sha256):  # .partial удалит _download — в dest не попадёт
+        sys.exit(f"❌  sha256 of {url.split('/')[-1]} differs from index.")
+
+def _fetch_extract(url: str, dest: Path, cmd: list[str] | None, wrap, drain: bool) -> None:
+    try:
+        # длинный RTT режет один TCP-поток — качаем кусками, потом распаковываем
+        if DL_PARTS > 1 and (probe := _probe_ranges(url)):
+            with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX) as f:
+                if _download_parts(*probe, f):
+                    f.seek(0)
+                    _extract(cmd, url, wrap(f), dest, drain)
+                    return
+        # иначе распаковываем прямо из сокета: сеть и tar работают внахлёст
+        r = _get(url, {"Accept": "application/octet-stream"}, preload_content=False)
+        r.auto_close = False            # EOF читает BufferedReader, закрываем сами
+    except urllib3.exceptions.HTTPError as e:
+        sys.exit(f"❌  Cannot download archive ({e}).")
+    if cmd:
+        src, pump, errors = wrap(io.BufferedReader(r, buffer_size=READ_BUF)), None, []
+    else:
+        src, pump, errors = _pump(wrap(r))  # tarfile однопоточный — сеть читает отдельный поток
+    failed = None
+    try:
+        _extract(cmd, url, src, dest, drain)
+    except urllib3.exceptions.HTTPError as e:     # обрыв при дочитывании хвоста (drain)
+        sys.exit(f"❌  Cannot download archive ({e}).")
+    except (tarfile.TarError, EOFError) as e:
+        failed = e                      # сперва дождёмся pump: виновата может быть сеть
+    finally:
+        src.close()                     # до join: иначе pump навсегда встанет в write() в полный pipe
+        if pump: pump.join()            # до commit: пишущий в blob поток должен закончить
+        r.close()                       # после раннего выхода хвост ответа не дочитан
+        r.release_conn()
+    # обрыв внутри 512-байтного заголовка streaming tarfile принимает за конец архива,
+    # так что ошибку сети проверяем и после «успешной» распаковки
+    if errors:
+        sys.exit(f"❌  Cannot download archive ({errors[0]}).")
+    if failed:
+        sys.exit(f"❌  Cannot extract archive ({failed}).")
+
+def ensure(ver: str) -> Path:
     """Resolve + download if needed, return …/bin/python"""
     if _RX_BRANCH.match(ver):
         ver = _latest(ver) or sys.exit(f"No builds for {ver}.x in index.")
@@ -75,17 +422,23 @@ def _ensure(ver: str) -> Path:
     dest = ISOPY_HOME / ver
     py   = dest / "bin" / "python"
     if not py.exists():
-        url = INDEX.get(ver) or sys.exit(f"{ver} absent from index.")
-        _download(url, dest)
+        url = _index().get(ver) or sys.exit(f"{ver} absent from index.")
+        url, sha256 = _split_hash(url)
+        ISOPY_HOME.mkdir(parents=True, exist_ok=True)
+        with open(ISOPY_HOME / f".{ver}.lock", "w") as lock:
+            if fcntl:                   # одну версию ставит один процесс, остальные ждут
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            if not py.exists():         # пока ждали, сосед уже поставил
+                _download(url, dest, sha256)
     return py
 
 # ───────────── CLI commands ──────────────────────────────────────────────────
 def _cmd_install(a):
-    py = _ensure(a.version)
+    py = ensure(a.version)
     print(f"✔  {py}")
 
 def _cmd_use(a):
-    py = _ensure(a.version)
+    py = ensure(a.version)
     subprocess.check_call(["poetry", "env", "use", str(py)])
 
 def _cmd_list(_):
@@ -94,6 +447,8 @@ def _cmd_list(_):
 
 def _cmd_update(_):
     CACHE_FILE.unlink(missing_ok=True)
+    _index.cache_clear()
+    _branch_heads.cache_clear()
     _download_index()
     print("✔  Index updated.")
 
@@ -1,51 +1,64 @@
 #!/usr/bin/env python3
 """
-build-index.py – генерирует index.json для isopy, обходя HTML-страницы GitHub,
-НЕ пользуясь REST-API и не требуя токенов.
+build-index.py – генерирует index.json для isopy из одного manifest-файла
+со списком сборок python-build-standalone, без парсинга HTML.
 
 Алгоритм
 ────────
-1. Проходит список релизов https://github.com/<repo>/releases?page=N.
-2. Для каждого тега /releases/tag/<TAG> скачивает страницу.
-   • Если список ассетов «схлопнут» ссылкой *Show all … assets*,
-     вытягивает фрагмент из include-fragment и парсит его.
-3. Забирает ссылки на архивы
-      cpython-X.Y.Z+…-<ARCH>-…install_only.tar.{zst|gz}
-   и строит словарь  { "X.Y.Z": "https://github.com/…download/…" }.
-4. Предпочитает полный архив (без «stripped») при совпадении версий.
-5. Сохраняет результат в index.json (UTF-8, с отступами).
+1. Скачивает MANIFEST_URL (download-metadata.json из репозитория uv —
+   URL и sha256 каждой сборки) — один запрос вместо сотен HTML-страниц.
+   • Если manifest отвечает 404, берёт ассеты из GitHub REST API
+     /releases (страницы запрашиваются параллельно).
+2. Забирает архивы
+      cpython-X.Y.Z+…-<ARCH>-install_only.tar.{zst|gz}
+   и строит словарь  { "X.Y.Z": "https://github.com/…download/…#sha256=<hex>" }
+   (хэш — если источник его знает; isopy по нему кэширует архивы).
+3. Предпочитает полный архив (без «stripped»), затем .tar.zst, при совпадении версий.
+4. Сохраняет результат в index.json (UTF-8, с отступами).
 
 Настройка
 ─────────
-• ARCH            – нужная архитектура; по умолчанию x86_64-unknown-linux-gnu  
-• ASSET_KIND      – строка-маркер в имени файла (install_only, stripped …)  
-• PAGE_MAX        – глубина пагинации /releases (10 страниц ≈ 1,5 года истории)
+• ARCH            – нужная архитектура; по умолчанию x86_64-unknown-linux-gnu
+• ASSET_KIND      – строка-маркер в имени файла (install_only, stripped …)
+• MANIFEST_URL    – откуда брать manifest (env ISOPY_MANIFEST_URL; .json или .json.gz)
+• PAGE_MAX        – глубина пагинации API-фолбэка (10 страниц ≈ 1,5 года истории)
+• GITHUB_TOKEN    – токен для API-фолбэка (необязателен, поднимает rate-limit)
 
-Зависимости:  requests, beautifulsoup4
+Зависимости:  requests
 """
 
 from __future__ import annotations
 
-import html
+import gzip
 import json
 import os
 import re
 import sys
 import time
 import pathlib
-from urllib.parse import urljoin
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, unquote, urlparse
 
 import requests
-from bs4 import BeautifulSoup
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
 # ───────────────────────────────────────────── Настройки ────────────────────────────────────────────
 REPO = "astral-sh/python-build-standalone"
-BASE = f"https://github.com/{REPO}"
+API = f"https://api.github.com/repos/{REPO}/releases"
+MANIFEST_URL = os.getenv(
+    "ISOPY_MANIFEST_URL",
+    "https://raw.githubusercontent.com/astral-sh/uv/main/crates/uv-python/download-metadata.json",
+)
 ARCH = os.getenv("ISOPY_ARCH", "x86_64-unknown-linux-gnu")
 ASSET_KIND = "install_only"
 PAGE_MAX = 10                       # глубина /releases?page=N (хватает на годы)
+PER_PAGE = 10                       # релизов на страницу API (ассетов в каждом ~1000)
+WORKERS = 8                         # параллельных HTTP-запросов
+API_WORKERS = 5                     # к API — не больше, иначе secondary rate limit
+RATE_WAIT_MAX = 15 * 60             # дольше ждать сброса лимита смысла нет
+RATE_RETRIES = 5                    # после стольких отказов подряд сдаёмся
 
 UA = (
     "Mozilla/5.0 (X11; Linux x86_64) "
@@ -67,88 +80,153 @@ retry_cfg = Retry(
     status_forcelist=[502, 503, 504],
     raise_on_status=False,
 )
-session.mount("https://", HTTPAdapter(max_retries=retry_cfg))
+session.mount("https://", HTTPAdapter(max_retries=retry_cfg, pool_maxsize=WORKERS))
+
+API_HEADERS = {"Accept": "application/vnd.github+json"}
+if token := os.getenv("GITHUB_TOKEN"):
+    API_HEADERS["Authorization"] = f"Bearer {token}"
 
 # ───────────────────────────────────────────── Регулярки ────────────────────────────────────────────
-rx_tag_link = re.compile(r"/releases/tag/(?P<tag>[^\"/]+)$")
-rx_rel_ver = re.compile(r"cpython-(\d+\.\d+\.\d+)")
-rx_asset = re.compile(
-    rf"/{REPO}/releases/download/(?P<tag>[^\"/]+)/"
-    rf"[^\"/]*{ARCH}[^\"/]*{ASSET_KIND}[^\"/]*\.(?:tar\.gz|tar\.zst)"
+# применяется к имени файла через .match (якорь в начале) и $ в конце;
+# rc/beta-суффикс входит в ту же версию X.Y.Z
+RX = re.compile(
+    rf"cpython-(\d+\.\d+\.\d+)(?:[a-z]+\d+)?\+\d+-{re.escape(ARCH)}-"
+    rf"{ASSET_KIND}(?:_stripped)?\.tar\.(?:gz|zst)$"
 )
 
 # ───────────────────────────────────────────── Вспомогательные ─────────────────────────────────────
-def fetch(url: str) -> BeautifulSoup:
-    """GET url → BeautifulSoup (выход  sys.exit при non-200)."""
+def rate_limit_wait(r: requests.Response) -> float | None:
+    """Сколько секунд ждать, если GitHub ответил отказом по rate-limit, иначе None."""
+    if r.status_code not in (403, 429):
+        return None
+    if retry_after := r.headers.get("Retry-After"):
+        try:                                    # секунды или HTTP-date (RFC 9110)
+            return float(retry_after)
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+    reset = r.headers.get("X-RateLimit-Reset")
+    if r.headers.get("X-RateLimit-Remaining") == "0" and reset:
+        return max(0.0, float(reset) - time.time()) + 1
+    return None                                 # без момента сброса ждать нечего — это ошибка
+
+
+def fetch(url: str, missing_ok: bool = False, **kw) -> requests.Response | None:
+    """GET url → Response (sys.exit при non-200; None при 404, если missing_ok).
+
+    Вместо фиксированных пауз между запросами ждём только тогда,
+    когда сервер сам сообщил об исчерпанном лимите.
+    """
     try:
-        r = session.get(url, timeout=40)
+        for attempt in range(1, RATE_RETRIES + 1):
+            r = session.get(url, timeout=40, **kw)
+            wait = rate_limit_wait(r)
+            if wait is None or wait > RATE_WAIT_MAX or attempt == RATE_RETRIES:
+                break
+            print(f"… rate-limit, ждём {wait:.0f} с")
+            time.sleep(wait)
+        if missing_ok and r.status_code == 404:
+            return None
         r.raise_for_status()
     except requests.RequestException as e:
         sys.exit(f"❌ HTTP error for {url}: {e}")
-    return BeautifulSoup(r.text, "html.parser")
+    return r
+
+
+def with_hash(url: str, sha256: str | None) -> str:
+    """URL + '#sha256=<hex>' (как в pip): isopy по нему находит архив в своём кэше."""
+    return f"{url}#sha256={sha256}" if sha256 else url
+
+
+def sha256_of(asset: dict) -> str | None:
+    """GitHub отдаёт хэш ассета как "digest": "sha256:<hex>" (у старых релизов его нет)."""
+    algo, _, digest = (asset.get("digest") or "").partition(":")
+    return digest if algo == "sha256" else None
+
 
+def fetch_manifest() -> list[tuple[str, str]] | None:
+    """manifest (.json или .json.gz) → [(имя файла, URL)]; None, если manifest не найден.
 
-def expanded_assets(html_page: BeautifulSoup) -> str | None:
-    """Если есть include-fragment со всеми ассетами — вернём его src."""
-    frag = html_page.select_one("include-fragment[src*='expanded_assets']")
-    return frag["src"] if frag else None
+    Тело парсится прямо из сокета: без r.content и промежуточного BytesIO.
+    """
+    r = fetch(MANIFEST_URL, missing_ok=True, stream=True)
+    if r is None:
+        return None
+    with r:
+        r.raw.decode_content = True     # Content-Encoding снимает urllib3
+        src = r.raw
+        if MANIFEST_URL.endswith(".gz") and "gzip" not in r.headers.get("Content-Encoding", ""):
+            src = gzip.GzipFile(fileobj=src)
+        manifest = json.load(src)
+    assets = []
+    for entry in manifest.values():
+        url = entry["url"]
+        assets.append((unquote(url.rsplit("/", 1)[-1]), with_hash(url, entry.get("sha256"))))
+    return assets
 
 
-def collect_assets(tag_url: str) -> list[str]:
-    """Возвращает download-URL-ы ассетов, удовлетворяющих фильтрам."""
-    page = fetch(tag_url)
+def api_page(page_n: int) -> requests.Response:
+    return fetch(API, params={"per_page": PER_PAGE, "page": page_n}, headers=API_HEADERS)
 
-    # если список ассетов схлопнут
-    if frag := expanded_assets(page):
-        page = fetch(urljoin(BASE, frag))
 
-    links: list[str] = []
-    for a in page.select("a[href]"):
-        href = a["href"]
-        if rx_asset.search(href):
-            links.append(urljoin("https://github.com", html.unescape(href)))
-    return links
+def fetch_api() -> list[tuple[str, str]]:
+    """Фолбэк: ассеты первых PAGE_MAX страниц /releases через REST API."""
+    first = api_page(1)
+    last = 1
+    if "last" in first.links:
+        last = int(parse_qs(urlparse(first.links["last"]["url"]).query)["page"][0])
+
+    # номер последней страницы известен сразу — остальные тянем параллельно
+    with ThreadPoolExecutor(API_WORKERS) as ex:
+        pages = [first, *ex.map(api_page, range(2, min(last, PAGE_MAX) + 1))]
+
+    return [
+        (asset["name"], with_hash(asset["browser_download_url"], sha256_of(asset)))
+        for page in pages
+        for release in json.loads(page.content)
+        for asset in release["assets"]
+    ]
 
 
 # ───────────────────────────────────────────── Построение словаря ───────────────────────────────────
-def build_mapping() -> dict[str, str]:
+def asset_rank(url: str) -> tuple[bool, bool]:
+    """Чем больше, тем лучше: полный архив, затем zstd (распаковывается быстрее gzip)."""
+    url = url.partition("#")[0]
+    return "stripped" not in url, url.endswith(".tar.zst")
+
+
+def build_mapping(assets: list[tuple[str, str]]) -> dict[str, str]:
     mapping: dict[str, str] = {}
 
-    for page_n in range(1, PAGE_MAX + 1):
-        list_url = f"{BASE}/releases?page={page_n}"
-        rel_page = fetch(list_url)
-
-        # собираем ссылки на теги
-        tag_urls = {
-            urljoin(BASE, a["href"])
-            for a in rel_page.select("a[href*='/releases/tag/']")
-            if rx_tag_link.search(a["href"])
-        }
-        if not tag_urls:
-            break  # страницы кончились
-
-        for tag_url in tag_urls:
-            for asset_url in collect_assets(tag_url):
-                ver_match = rx_rel_ver.search(asset_url)
-                if not ver_match:
-                    continue
-                ver = ver_match.group(1)
-
-                # предпочитаем полный архив (без 'stripped')
-                if ver in mapping:
-                    if "stripped" in mapping[ver] and "stripped" not in asset_url:
-                        mapping[ver] = asset_url
-                else:
-                    mapping[ver] = asset_url
-
-        time.sleep(0.1)  # мелкая задержка, чтобы не ловить rate-limit
+    for name, asset_url in assets:
+        # дешёвый отсев подстроками: regex видит только кандидатов нужной arch/kind.
+        # RX.finditer по именам, склеенным через \n, не быстрее: якорь (?m)^ лишает
+        # движок поиска по литеральному префиксу, и выигрыш от цикла в C съедается
+        if ARCH not in name or ASSET_KIND not in name:
+            continue
+        m = RX.match(name)
+        if not m:
+            continue
+        ver = m.group(1)
+
+        # предпочитаем полный архив (без 'stripped'), при равенстве — .tar.zst
+        if ver not in mapping or asset_rank(asset_url) > asset_rank(mapping[ver]):
+            mapping[ver] = asset_url
 
     return mapping
 
 
 # ───────────────────────────────────────────── Точка входа ──────────────────────────────────────────
 def main() -> None:
-    mp = build_mapping()
+    assets = fetch_manifest()
+    if assets is None:
+        print(f"… {MANIFEST_URL} не найден, идём через GitHub API")
+        assets = fetch_api()
+
+    mp = build_mapping(assets)
     if not mp:
         sys.exit("❌ Не удалось найти ни одной подходящей сборки.")
 
@@ -160,5 +238,3 @@ def main() -> None:
 
 if __name__ == "__main__":
     main()
-
-